@@ -1,8 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from .runner import Watcher, MultiProcessingWatcher, Transer
-from .sinal2 import L2Client
-
+# runners are imported inside commands, importing them may pull in gevent
 import click
 import logging
 
@@ -20,17 +18,113 @@ def cli():
 @click.option('--out', '-o', default=None, help='output file if needed')
 @click.option('--core', '-c', type=int, default=1, help='num of cores(processes) to use')
 @click.option('--size', '-z', type=int, default=50, help='num of symbols per websocket')
+@click.option('--delta/--no-delta', default=False, is_flag=True, help='store raw frames as deltas')
+@click.option('--dashboard/--no-dashboard', default=False, is_flag=True, help='live view instead of printing every message')
+@click.option('--fps', type=float, default=2., help='dashboard frames per second')
 @click.argument('username', envvar='SINA_USERNAME')
 @click.argument('password', envvar='SINA_PASSWORD')
-def watch(username, password, symbols, raw, out, size, core):
+def watch(username, password, symbols, raw, out, size, core, delta, dashboard, fps):
     """ watch symbols """
+    from .runner import Watcher, MultiProcessingWatcher
+    if dashboard and core != 1:
+        raise click.UsageError('--dashboard only works with a single core')
+    if delta and not (raw and out):
+        raise click.UsageError('--delta only works with --raw and --out')
     if core == 1:
-        w = Watcher(username, password, symbols, raw, out, size)
+        w = Watcher(username, password, symbols, raw, out, size, delta,
+                    fps if dashboard else None)
     else:
-        w = MultiProcessingWatcher(username, password, symbols, raw, out, size, core)
+        w = MultiProcessingWatcher(username, password, symbols, raw, out, size, core, delta)
+    w.run()
+
+
+@cli.command()
+@click.argument('src')
+@click.argument('dst')
+def inflate(src, dst):
+    """ restore a --delta capture to plain raw """
+    from .delta import DeltaDecoder
+    DeltaDecoder.inflate(src, dst)
+
+
+@cli.command()
+@click.option('--shard', default='0/1', help='i/n, watch the i-th of n shards of all symbols')
+@click.option('--host', default='127.0.0.1', help='address to serve the raw stream on, 0.0.0.0 for other hosts')
+@click.option('--port', '-p', type=int, default=9000, help='port to serve the raw stream on')
+@click.option('--out', '-o', default=None, help='output file if needed')
+@click.option('--size', '-z', type=int, default=50, help='num of symbols per websocket')
+@click.argument('username', envvar='SINA_USERNAME')
+@click.argument('password', envvar='SINA_PASSWORD')
+def worker(username, password, shard, host, port, out, size):
+    """ watch a shard of all symbols for sinal2 merge """
+    from .runner import ShardWatcher, get_all_symbols, patch
+    i, n = [int(x) for x in shard.split('/')]
+    if not 0 <= i < n:
+        raise click.BadParameter('expect i/n with 0 <= i < n', param_hint='--shard')
+    patch()
+    w = ShardWatcher(username, password, get_all_symbols()[i::n], out, port, size, host)
     w.run()
 
 
+@cli.command()
+@click.option('--out', '-o', required=True, help='merged output file')
+@click.option('--timeout', '-t', type=float, default=3., help='seconds to wait for a silent worker')
+@click.option('--lag', '-l', type=float, default=1., help='seconds of disorder allowed within a worker')
+@click.option('--wait', '-w', type=int, default=60, help='seconds to wait for a worker to come (back) up')
+@click.argument('sources', nargs=-1, required=True)
+def merge(sources, out, timeout, lag, wait):
+    """ merge worker streams (host:port or files) by exchange time """
+    import threading
+    from .merge import StreamMerger, open_source
+    stop = threading.Event()
+    merger = StreamMerger([open_source(s, wait, stop) for s in sources], timeout, lag, stop=stop)
+    with open(out, 'ab') as f:
+        merger.run(f)
+
+
+@cli.command()
+@click.option('--account', '-a', 'accounts', multiple=True, required=True,
+              help='username:password, one worker process per account')
+@click.option('--symbol', '-s', 'symbols', multiple=True, help='symbols to watch')
+@click.option('--out', '-o', required=True, help='merged output file')
+@click.option('--port', '-p', type=int, default=9000, help='first port of the workers')
+@click.option('--size', '-z', type=int, default=50, help='num of symbols per websocket')
+def cluster(accounts, symbols, out, port, size):
+    """ watch with several accounts on this host and merge """
+    from .runner import ClusterWatcher
+    accounts = [a.split(':', 1) for a in accounts]
+    if any(len(a) != 2 for a in accounts):
+        raise click.BadParameter('expect username:password', param_hint='--account')
+    w = ClusterWatcher(accounts, symbols, out, port, size)
+    w.run()
+
+
+@cli.command()
+@click.option('--interval', '-i', type=int, default=10, help='seconds between checkpoints')
+@click.option('--lag', '-l', type=int, default=5, help='max seconds a record may arrive late')
+@click.argument('capture')
+def index(capture, interval, lag):
+    """ index a raw capture for asof queries """
+    from .index import L2Index
+    L2Index.build(capture, interval, lag)
+
+
+@cli.command()
+@click.option('--symbol', '-s', 'symbols', multiple=True, help='symbols to query')
+@click.argument('capture')
+@click.argument('when')
+def asof(capture, when, symbols):
+    """ state of symbols at WHEN (e.g. 10:30:00.000) of an indexed capture """
+    import json
+    from .index import L2Index
+    try:
+        L2Index.seconds(when)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='WHEN')
+    for symbol, state in sorted(L2Index(capture).asof(when, symbols).items()):
+        print(json.dumps(state))
+
+
 @cli.command()
 @click.option('--symbol', '-s', 'symbols', multiple=True, help='symbol to download')
 @click.option('--out', '-o', default=None, help='output file if needed')
@@ -38,6 +132,7 @@ def watch(username, password, symbols, raw, out, size, core):
 @click.argument('password', envvar='SINA_PASSWORD')
 def trans(username, password, symbols, out):
     """ download trans """
+    from .runner import Transer
     t = Transer(username, password, symbols, out)
     t.run()
 
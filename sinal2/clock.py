@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Watermark of a raw level2 stream
+
+Sina sends the last frame of every channel (``2cn_X``, ``2cn_X_orders``,
+``2cn_X_0``...) on subscription, so a capture started before the open begins
+with last close's frames, and illiquid symbols keep sending snapshots with
+old times during the day. Clock tells these apart from the stream moving on::
+
+    clock = Clock()
+    for channel, ts, line in lines:
+        accepted, dropped = clock.feed(channel, ts, line)
+    dropped = clock.finish()
+
+The watermark is the newest accepted time. A line at most ``jump`` seconds
+ahead of it is accepted, late lines included. A line further ahead (or any
+line before the watermark is known) is held until the next line of its
+channel confirms it, being newer and at most ``jump`` later, which moves the
+watermark there (start of capture, end of the lunch break), or until the
+watermark catches up. It is dropped if its channel goes back in time
+instead, or if the stream ends first.
+"""
+import heapq
+
+
+class Clock(object):
+
+    def __init__(self, jump=300):
+        self.jump = jump
+        self.value = None
+        self.held = {}
+        self.top = {}
+        self.heap = []
+
+    def feed(self, channel, ts, item):
+        """ lists of (ts, item) accepted and dropped with this line """
+        dropped = []
+        held = self.held.get(channel)
+        if held:
+            last = held[-1][0]
+            if ts < last - self.jump:
+                dropped = self.pop(channel)
+            elif ts > last and ts <= last + self.jump:
+                accepted = self.pop(channel)
+                accepted.append((ts, item))
+                return accepted + self.advance(ts), dropped
+        if self.value is not None and ts <= self.value + self.jump:
+            return [(ts, item)] + self.advance(ts), dropped
+        self.hold(channel, ts, item)
+        return [], dropped
+
+    def finish(self):
+        """ drop what is still held at the end of the stream """
+        dropped = []
+        for channel in list(self.held):
+            dropped.extend(self.pop(channel))
+        return dropped
+
+    def hold(self, channel, ts, item):
+        self.held.setdefault(channel, []).append((ts, item))
+        if ts > self.top.get(channel, -1):
+            self.top[channel] = ts
+            heapq.heappush(self.heap, (ts, channel))
+
+    def pop(self, channel):
+        self.top.pop(channel, None)
+        return self.held.pop(channel)
+
+    def advance(self, ts):
+        """ move the watermark to ts, held lines it caught up with are accepted """
+        if self.value is not None and ts <= self.value:
+            return []
+        self.value = ts
+        released = []
+        while self.heap and self.heap[0][0] <= ts + self.jump:
+            top, channel = heapq.heappop(self.heap)
+            if self.top.get(channel) == top:
+                released.extend(self.pop(channel))
+        return released
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Delta compression of raw level2 captures
+
+Most ``2cn_X`` and ``2cn_X_orders`` frames only differ from the previous
+frame of the same channel by a few fields (often just the time), so instead
+of the full line we store the changed fields only::
+
+    2cn_sh601398=工商银行,15:05:10,2017-07-12,5.060,...
+    2cn_sh601398~1:15:05:13,10:219835388
+
+A delta line is ``<channel>~<index>:<value>,...`` against the last frame of
+that channel; ``<channel>~`` alone repeats the last frame unchanged.
+Lines without ``=`` are kept as they are, so a plain capture is also a valid
+delta capture and appending to an existing file is fine: the first frame of
+every channel after a restart is always written in full.
+
+>>> e, d = DeltaEncoder(), DeltaDecoder()
+>>> d.decode(e.encode(data)) == data
+True
+"""
+import logging
+
+
+log = logging.getLogger('sinal2')
+
+
+class DeltaEncoder(object):
+
+    def __init__(self):
+        self.last = {}
+
+    def encode_line(self, line):
+        idx = line.find(b'=')
+        if idx < 0:
+            return line
+        key, fields = line[:idx], line[idx+1:].split(b',')
+        last = self.last.get(key)
+        self.last[key] = fields
+        if last is None or len(last) != len(fields):
+            return line
+        changes = [str(i).encode('ascii') + b':' + v
+                   for i, (u, v) in enumerate(zip(last, fields)) if u != v]
+        delta = key + b'~' + b','.join(changes)
+        if len(delta) >= len(line):
+            return line
+        return delta
+
+    def encode(self, data):
+        """ encode a raw websocket frame (bytes), one output line per input line """
+        result = []
+        for line in data.split(b'\n'):
+            line = line.strip()
+            if line:
+                result.append(self.encode_line(line) + b'\n')
+        return b''.join(result)
+
+
+class DeltaDecoder(object):
+
+    def __init__(self):
+        self.last = {}
+
+    def decode_line(self, line):
+        idx = line.find(b'=')
+        didx = line.find(b'~')
+        if didx < 0 or (0 <= idx < didx):
+            if idx >= 0:
+                self.last[line[:idx]] = line[idx+1:].split(b',')
+            return line
+        key = line[:didx]
+        if key not in self.last:
+            raise ValueError('delta without base frame: {}'.format(
+                line.decode('utf-8', 'replace')))
+        fields = list(self.last[key])
+        changes = line[didx+1:]
+        if changes:
+            for change in changes.split(b','):
+                i, v = change.split(b':', 1)
+                fields[int(i)] = v
+        self.last[key] = fields
+        return key + b'=' + b','.join(fields)
+
+    def decode(self, data):
+        result = []
+        for line in data.split(b'\n'):
+            line = line.strip()
+            if line:
+                result.append(self.decode_line(line) + b'\n')
+        return b''.join(result)
+
+    @classmethod
+    def iter_lines(cls, path):
+        """ yield the lines of a capture, delta lines are expanded
+
+        decoding needs the base frames, so a delta capture is always read
+        from its start
+        """
+        d = cls()
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield d.decode_line(line)
+
+    @classmethod
+    def inflate(cls, src, dst, chunk=10000):
+        """ reconstruct the plain raw capture from a delta capture """
+        with open(dst, 'wb') as f:
+            lines = []
+            for line in cls.iter_lines(src):
+                lines.append(line)
+                if len(lines) >= chunk:
+                    f.write(b'\n'.join(lines) + b'\n')
+                    lines = []
+            if lines:
+                f.write(b'\n'.join(lines) + b'\n')
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" As-of snapshot queries over a recorded day
+
+The index is built once over a raw capture (``sinal2 watch --raw -o``) and
+stores the state of every symbol (10 level book and last trade) every
+``interval`` seconds, a query then loads the nearest checkpoint and only
+replays the tail of the capture, Usage::
+
+>>> L2Index.build('all.l2', interval=10)
+>>> idx = L2Index('all.l2')
+>>> idx.asof('10:30:00.000')['sh601398']['quote']['bids'][0]
+{'price': 5.08, 'volume': 379972}
+
+Three files are written next to the capture: ``<capture>.idx`` (json meta),
+``<capture>.ckpt`` with float64 rows of ``FIELDS``, only for the symbols that
+changed since the previous checkpoint, and ``<capture>.ptr`` with the int32
+row of every symbol at every checkpoint. Both are memory mapped at query time.
+
+Times are seconds of day (exchange clock) with millisecond precision. The
+state at T holds, per symbol, the quote and the trade with the latest
+timestamp not after T. Records arriving more than ``lag`` seconds behind
+the newest timestamp seen in the capture are not guaranteed to be picked up.
+Quotes dated another day than the capture and stray lines far ahead of the
+stream (see clock.Clock) are ignored, their offsets are kept in the meta so
+queries skip the same lines.
+
+Delta captures (``--delta``) have to be inflated first.
+"""
+import os
+import re
+import json
+import mmap
+import array
+import bisect
+import logging
+
+from .sinal2 import L2Parser
+from .clock import Clock
+
+
+log = logging.getLogger('sinal2')
+
+NAN = float('nan')
+
+
+class L2Index(object):
+
+    QUOTE_FIELDS = (
+        ['quote_time', 'price', 'pre_close', 'open', 'high', 'low', 'volume', 'money'] +
+        ['bid{}_{}'.format(i, k) for i in range(1, 11) for k in ('price', 'volume')] +
+        ['ask{}_{}'.format(i, k) for i in range(1, 11) for k in ('price', 'volume')]
+    )
+    TRADE_FIELDS = ['trade_time', 'trade_price', 'trade_volume', 'trade_iotype']
+    FIELDS = QUOTE_FIELDS + TRADE_FIELDS
+    NQ = len(QUOTE_FIELDS)
+    VERSION = 2
+
+    PAT_DAY = re.compile(rb'^2cn_[a-z0-9]{8}=[^,\n]*,[^,\n]*,(\d{4}-\d\d-\d\d),', re.M)
+    PAT_WHEN = re.compile(r'^([01]\d|2[0-3]):([0-5]\d):([0-5]\d)(?:\.\d{3})?$')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.idx', 'r') as f:
+            meta = json.load(f)
+        if meta.get('fields') != self.FIELDS or meta.get('version') != self.VERSION:
+            raise ValueError('index of {} is outdated, rebuild it'.format(path))
+        if meta['size'] != os.path.getsize(path):
+            log.warning('{} changed after indexing, only its tail is replayed'.format(path))
+        self.day = meta['day'].encode('ascii') if meta['day'] else None
+        self.lag = meta['lag']
+        self.symbols = meta['symbols']
+        self.slots = {s: i for i, s in enumerate(self.symbols)}
+        self.times = meta['times']
+        self.offsets = meta['offsets']
+        self.starts = meta['starts']
+        self.counts = meta['counts']
+        self.strays = set(meta['strays'])
+        self.rows = self.load(path + '.ckpt', 'd')
+        self.pointers = self.load(path + '.ptr', 'i')
+
+    @classmethod
+    def load(cls, path, fmt):
+        """ memory mapped array of a checkpoint file """
+        if not os.path.getsize(path):
+            return memoryview(b'').cast(fmt)
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mm).cast(fmt)
+
+    @classmethod
+    def seconds(cls, when):
+        """ 'HH:MM:SS' or 'HH:MM:SS.fff' or seconds of day """
+        if isinstance(when, str):
+            if not cls.PAT_WHEN.match(when):
+                raise ValueError('expect HH:MM:SS[.fff], got {!r}'.format(when))
+            return L2Parser.timeof(when.encode('ascii'))
+        if isinstance(when, bool) or not isinstance(when, (int, float)) or not 0 <= when < 86400:
+            raise ValueError('expect seconds of day, got {!r}'.format(when))
+        return when
+
+    @classmethod
+    def capture_day(cls, path, tail=1 << 20):
+        """ date of the latest quote in a capture, read from its end """
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            while True:
+                f.seek(max(size - tail, 0))
+                days = cls.PAT_DAY.findall(f.read(tail))
+                if days or tail >= size:
+                    return max(days) if days else None
+                tail *= 4
+
+    @classmethod
+    def scan(cls, f, day=None, symbols=None, skip=()):
+        """ yield (pos, channel, ts, records) of the lines from the position of f
+
+        records are ('quote', symbol, ts, (key, value)) with the raw line,
+        parsed only if it ends up in a result, and ('trans', symbol, ts, row);
+        lines at the offsets in `skip` are left out
+        """
+        offset = f.tell()
+        for line in f:
+            pos, offset = offset, offset + len(line)
+            if pos in skip:
+                continue
+            line = line.strip()
+            idx = line.find(b'=')
+            if idx < 0:
+                if line.find(b'~') >= 0:
+                    raise ValueError('delta capture, run `sinal2 inflate` first')
+                continue
+            key, value = line[:idx].decode('utf-8'), line[idx+1:]
+            symbol = key[4:12]
+            wanted = symbols is None or symbol in symbols
+            recs = []
+            if L2Parser.PAT_QUOTE.match(key):
+                fields = value.split(b',', 3)
+                if len(fields) < 4:
+                    continue
+                if day and fields[2] != day:
+                    # stale snapshot of another day
+                    continue
+                ts = L2Parser.timeof(fields[1])
+                if wanted:
+                    recs.append(('quote', symbol, ts, (key, value)))
+            elif wanted and L2Parser.PAT_TRANS.match(key):
+                ts = None
+                for r in value.split(b','):
+                    v = r.split(b'|')
+                    if len(v) > 7 and v[1]:
+                        t = L2Parser.timeof(v[1])
+                        ts = t if ts is None or t > ts else ts
+                        if wanted:
+                            recs.append(('trans', symbol, t,
+                                         [t, float(v[2]), int(v[3]), int(v[7])]))
+            else:
+                # first time of the line, enough for lines not wanted
+                ts = L2Parser.timeof(value)
+            if ts is not None:
+                yield pos, key, ts, recs
+
+    @classmethod
+    def find_strays(cls, path, day=None):
+        """ sorted offsets of the lines of a capture dropped by Clock """
+        clock, strays = Clock(), []
+        with open(path, 'rb') as f:
+            for pos, channel, ts, _ in cls.scan(f, day, ()):
+                strays.extend(p for _, p in clock.feed(channel, ts, pos)[1])
+        strays.extend(p for _, p in clock.finish())
+        if strays:
+            log.info('ignored {} stray lines'.format(len(strays)))
+        return sorted(strays)
+
+    @classmethod
+    def apply(cls, state, rec, since=None, until=None):
+        """ keep a record in state if it is the latest of its kind in (since, until] """
+        kind, symbol, ts, payload = rec
+        if (since is not None and ts <= since) or (until is not None and ts > until):
+            return
+        entry = state.get(symbol)
+        if entry is None:
+            entry = state[symbol] = [None, None]
+        i = 0 if kind == 'quote' else 1
+        if entry[i] is None or not ts < entry[i][0]:
+            entry[i] = (ts, payload)
+
+    @classmethod
+    def row(cls, entry):
+        """ float row of a state entry, raw quotes are parsed here """
+        quote, trade = entry
+        row = [NAN] * len(cls.FIELDS)
+        if quote is not None:
+            ts, payload = quote
+            if isinstance(payload, tuple):
+                key, value = payload
+                q = L2Parser.parse_quote(key, value.decode('utf-8'))
+                payload = (
+                    [ts, q['price'], q['pre_close'], q['open'], q['high'],
+                     q['low'], q['volume'], q['money']] +
+                    [v for x in q['bids'] for v in (x['price'], x['volume'])] +
+                    [v for x in q['asks'] for v in (x['price'], x['volume'])]
+                )
+                entry[0] = (ts, payload)
+            row[:cls.NQ] = payload
+        if trade is not None:
+            row[cls.NQ:] = trade[1]
+        return row
+
+    @classmethod
+    def build(cls, path, interval=10, lag=5, day=None):
+        """ index a raw capture, lag must be smaller than interval
+
+        a first pass finds the stray lines, the second one writes checkpoints
+        """
+        assert 0 <= lag < interval
+        day = day or cls.capture_day(path)
+        strays = cls.find_strays(path, day)
+        state, pending, changed = {}, [], set()
+        symbols, slots, pointers = [], {}, array.array('i')
+        times, offsets, starts, counts = [], [], [], []
+        boundary, crossed, watermark = None, None, -1
+        nrows, written = 0, 0
+
+        ckpt = open(path + '.ckpt', 'wb')
+        ptr = open(path + '.ptr', 'wb')
+
+        def checkpoint(pos):
+            """ finalize the checkpoint at boundary, pos is the current line """
+            nonlocal pending, boundary, crossed, nrows, written
+            for symbol in sorted(set(state) - set(slots)):
+                slots[symbol] = len(symbols)
+                symbols.append(symbol)
+                pointers.append(-1)
+            times.append(boundary)
+            offsets.append(crossed if crossed is not None else pos)
+            if changed or not starts:
+                data = array.array('d')
+                for symbol in changed:
+                    data.extend(cls.row(state[symbol]))
+                    pointers[slots[symbol]] = nrows
+                    nrows += 1
+                data.tofile(ckpt)
+                pointers.tofile(ptr)
+                starts.append(written)
+                written += len(pointers)
+            else:
+                starts.append(starts[-1])
+            counts.append(len(symbols))
+            changed.clear()
+            boundary += interval
+            crossed = pos if watermark > boundary else None
+            recs, pending = pending, []
+            for rec in recs:
+                if rec[2] <= boundary:
+                    cls.apply(state, rec)
+                    changed.add(rec[1])
+                else:
+                    pending.append(rec)
+
+        with open(path, 'rb') as f:
+            for pos, _, ts, recs in cls.scan(f, day, None, set(strays)):
+                if boundary is None:
+                    boundary = ts // interval * interval
+                if ts > watermark:
+                    watermark = ts
+                if crossed is None and watermark > boundary:
+                    crossed = pos
+                for rec in recs:
+                    if rec[2] <= boundary:
+                        cls.apply(state, rec)
+                        changed.add(rec[1])
+                    else:
+                        pending.append(rec)
+                while watermark > boundary + lag:
+                    checkpoint(pos)
+            offset = f.tell()
+            if boundary is not None:
+                checkpoint(offset)
+                while pending:
+                    checkpoint(offset)
+        ckpt.close()
+        ptr.close()
+
+        meta = {
+            'version': cls.VERSION,
+            'size': offset,
+            'day': day.decode('ascii') if day else None,
+            'interval': interval,
+            'lag': lag,
+            'fields': cls.FIELDS,
+            'symbols': symbols,
+            'times': times,
+            'offsets': offsets,
+            'starts': starts,
+            'counts': counts,
+            'strays': strays,
+        }
+        with open(path + '.idx', 'w') as f:
+            json.dump(meta, f)
+        log.info('indexed {} symbols, {} checkpoints, {} rows'.format(
+            len(symbols), len(times), nrows))
+
+    def todict(self, symbol, row):
+        nq = self.NQ
+        result = {'symbol': symbol, 'quote': None, 'trade': None}
+        if row[0] == row[0]:
+            result['quote'] = {
+                'timestamp': row[0],
+                'price': row[1], 'pre_close': row[2], 'open': row[3],
+                'high': row[4], 'low': row[5], 'volume': int(row[6]), 'money': row[7],
+                'bids': [{'price': row[i], 'volume': int(row[i+1])}
+                         for i in range(8, 28, 2)],
+                'asks': [{'price': row[i], 'volume': int(row[i+1])}
+                         for i in range(28, nq, 2)],
+            }
+        if row[nq] == row[nq]:
+            result['trade'] = {
+                'timestamp': row[nq], 'price': row[nq+1], 'volume': int(row[nq+2]),
+                'iotype': str(int(row[nq+3])),
+            }
+        return result
+
+    def asof(self, when, symbols=None):
+        """ state of symbols (default all) at time `when`, as dict of symbol -> state """
+        until = self.seconds(when)
+        wanted = set(symbols) if symbols else None
+        state = {}
+        k = bisect.bisect_right(self.times, until) - 1
+        if k >= 0:
+            since, offset = self.times[k], self.offsets[k]
+            n, nq, width = self.counts[k], self.NQ, len(self.FIELDS)
+            for symbol in (symbols or self.symbols):
+                i = self.slots.get(symbol)
+                if i is not None and i < n:
+                    start = self.pointers[self.starts[k] + i] * width
+                    row = self.rows[start:start+width].tolist()
+                    state[symbol] = [
+                        (row[0], row[:nq]) if row[0] == row[0] else None,
+                        (row[nq], row[nq:]) if row[nq] == row[nq] else None,
+                    ]
+        else:
+            since, offset = None, 0
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for pos, _, ts, recs in self.scan(f, self.day, wanted, self.strays):
+                for rec in recs:
+                    self.apply(state, rec, since, until)
+                if ts > until + self.lag:
+                    break
+
+        return {symbol: self.todict(symbol, self.row(entry))
+                for symbol, entry in state.items() if entry != [None, None]}
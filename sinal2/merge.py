@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Multi-account, multi-node ingest
+
+The symbol universe is split into shards, each shard is watched by a worker
+with its own account (``runner.ShardWatcher``), which writes its own raw
+stream and serves it over tcp as newline separated lines::
+
+    sinal2 worker --shard 0/2 --host 0.0.0.0 -p 9000 -o shard0.l2 USER0 PASS0    # host a
+    sinal2 worker --shard 1/2 --host 0.0.0.0 -p 9000 -o shard1.l2 USER1 PASS1    # host b
+    sinal2 merge -o all.l2 a:9000 b:9000
+
+StreamMerger does a k-way merge of the worker streams by exchange time.
+A line is written once every worker that has been heard from within
+``timeout`` seconds has sent something newer (minus ``lag``), so a late or
+missing worker only holds the merge back for ``timeout`` seconds; its lines
+arriving after that are written immediately and counted as ``late``.
+Stray lines far ahead of the stream (see clock.Clock), like last close's
+frames sent on subscription, are passed through at the end without moving
+the merge, and counted as ``strays``.
+Memory is bounded by ``buffer`` lines. A worker never waits for a merger:
+a merger that falls ``backlog`` frames behind is disconnected, and it
+reconnects to a worker that went away until it is stopped.
+
+The stream is not authenticated, workers listen on 127.0.0.1 unless told
+otherwise.
+
+Sources can also be worker files, which merges a finished day offline.
+"""
+import os
+import time
+import heapq
+import queue
+import socket
+import logging
+import threading
+
+from .sinal2 import L2Parser
+from .clock import Clock
+
+
+log = logging.getLogger('sinal2')
+
+
+class StreamServer(object):
+    """ publishes raw frames to every connected merger
+
+    every merger has its own queue of at most `backlog` frames drained by a
+    sender thread, publish never blocks and drops mergers that fall behind
+    """
+
+    def __init__(self, host='127.0.0.1', port=9000, backlog=10000):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(5)
+        self.backlog = backlog
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                break
+            log.info('merger connected from {}:{}'.format(*addr))
+            q = queue.Queue(maxsize=self.backlog)
+            with self.lock:
+                self.clients[conn] = q
+            t = threading.Thread(target=self.send, args=(conn, q))
+            t.daemon = True
+            t.start()
+
+    def send(self, conn, q):
+        while True:
+            data = q.get()
+            if data is None:
+                break
+            try:
+                conn.sendall(data)
+            except OSError:
+                self.drop(conn, 'merger disconnected')
+                break
+
+    def drop(self, conn, reason):
+        with self.lock:
+            q = self.clients.pop(conn, None)
+        if q is None:
+            return
+        log.info(reason)
+        try:
+            q.put_nowait(None)
+        except queue.Full:
+            pass
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
+    def start(self):
+        t = threading.Thread(target=self.accept)
+        t.daemon = True
+        t.start()
+
+    def publish(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        slow = []
+        with self.lock:
+            for conn, q in self.clients.items():
+                try:
+                    q.put_nowait(data)
+                except queue.Full:
+                    slow.append(conn)
+        for conn in slow:
+            self.drop(conn, 'merger is {} frames behind, dropped'.format(self.backlog))
+
+    def close(self):
+        try:
+            # wakes up a blocking accept, close alone leaves it listening
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        with self.lock:
+            conns = list(self.clients)
+        for conn in conns:
+            self.drop(conn, 'merger disconnected')
+
+
+def tcp_source(host, port, wait=60, stop=None):
+    """ lines from a worker until `stop` is set
+
+    connecting is retried for `wait` seconds, also after the worker went away
+    """
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        deadline = time.time() + wait
+        while not stop.is_set():
+            try:
+                sock = socket.create_connection((host, port), timeout=5)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    log.error('worker {}:{} is missing'.format(host, port))
+                    return
+                time.sleep(0.2)
+        else:
+            return
+        sock.settimeout(1)
+        log.info('connected to worker {}:{}'.format(host, port))
+        buf = b''
+        with sock:
+            while not stop.is_set():
+                try:
+                    data = sock.recv(1 << 16)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                if not data:
+                    break
+                lines = (buf + data).split(b'\n')
+                buf = lines.pop()
+                for line in lines:
+                    yield line
+        if not stop.is_set():
+            log.info('worker {}:{} closed, reconnecting'.format(host, port))
+
+
+def file_source(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            yield line
+
+
+def open_source(spec, wait=60, stop=None):
+    """ a worker file path or host:port """
+    if os.path.exists(spec):
+        return file_source(spec)
+    host, _, port = spec.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError('source should be a file or host:port, got {}'.format(spec))
+    return tcp_source(host, int(port), wait, stop)
+
+
+class StreamMerger(object):
+    """ merges sources by exchange time, `stop` is shared with tcp sources """
+
+    def __init__(self, sources, timeout=3., lag=1., buffer=100000, stop=None):
+        self.sources = list(sources)
+        self.timeout = timeout
+        self.lag = lag
+        self.buffer = buffer
+        self.inbox = queue.Queue(maxsize=buffer)
+        self.stopped = stop or threading.Event()
+        self.late = 0
+        self.strays = 0
+
+    def stop(self):
+        """ write what is buffered and finish """
+        self.stopped.set()
+
+    def read(self, i, source):
+        try:
+            for line in source:
+                line = line.strip()
+                if line:
+                    self.inbox.put((i, line))
+        except Exception:
+            log.exception('source {} failed'.format(i))
+        finally:
+            self.inbox.put((i, None))
+
+    def limit(self, alive, marks, heard, now):
+        """ lines up to this time can be written """
+        ms = []
+        for i in alive:
+            if now - heard[i] <= self.timeout:
+                ms.append(marks[i] if marks[i] is not None else -1)
+        return min(ms) - self.lag if ms else float('inf')
+
+    def __iter__(self):
+        n = len(self.sources)
+        for i, source in enumerate(self.sources):
+            t = threading.Thread(target=self.read, args=(i, source))
+            t.daemon = True
+            t.start()
+
+        alive = set(range(n))
+        marks = [None] * n
+        heard = [time.time()] * n
+        heap, seq, last = [], 0, None
+        clock, strays = Clock(), []
+        while (alive or heap) and not self.stopped.is_set():
+            try:
+                i, line = self.inbox.get(timeout=0.1)
+            except queue.Empty:
+                i, line = None, None
+            now = time.time()
+            if i is not None:
+                heard[i] = now
+                if line is None:
+                    alive.discard(i)
+                else:
+                    ts = L2Parser.timeof(line)
+                    if ts is None:
+                        accepted = []
+                        yield line
+                    else:
+                        channel = line[:line.find(b'=')]
+                        accepted, dropped = clock.feed(channel, ts, (i, line))
+                        strays.extend(dropped)
+                    for ts, (j, line) in accepted:
+                        if last is not None and ts < last:
+                            self.late += 1
+                            yield line
+                        else:
+                            if marks[j] is None or ts > marks[j]:
+                                marks[j] = ts
+                            heapq.heappush(heap, (ts, seq, line))
+                            seq += 1
+
+            limit = self.limit(alive, marks, heard, now)
+            while heap and (heap[0][0] <= limit or len(heap) > self.buffer):
+                last, _, line = heapq.heappop(heap)
+                yield line
+
+        while heap:
+            yield heapq.heappop(heap)[2]
+        strays.extend(clock.finish())
+        for _, (_, line) in sorted(strays, key=lambda s: s[0]):
+            self.strays += 1
+            yield line
+        if self.strays:
+            log.info('{} stray lines written at the end'.format(self.strays))
+        if self.late:
+            log.warning('{} lines arrived too late to be ordered'.format(self.late))
+
+    def run(self, out):
+        """ write the merged stream to file object `out` """
+        for line in self:
+            out.write(line + b'\n')
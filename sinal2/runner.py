@@ -1,44 +1,81 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-""" sina l2 runner that runs sinal2 in high concurrency mode """
-from gevent import monkey
-monkey.patch_all()
+""" sina l2 runner that runs sinal2 in high concurrency mode
 
+gevent/gipc are only loaded (and monkey patched) by runners that need more
+than one websocket, a single websocket watcher runs without them
+"""
 import re
 import time
 import math
 import json
 import logging
+import threading
 import functools
 
-import tqdm
-import gipc
-import gevent
-import requests
-from .sinal2 import L2Client
+from .sinal2 import L2Client, L2Dashboard, Helper
+from .delta import DeltaEncoder
+from .merge import StreamServer, StreamMerger, tcp_source
 
 
 log = logging.getLogger('sinal2')
 
 
-def get_all_symbols():
+def patch():
+    """ gevent monkey patch, must be called before requests is imported """
+    from gevent import monkey
+    if not monkey.is_module_patched('socket'):
+        monkey.patch_all()
+
+
+# fewer symbols than this means sina returned an error or partial page
+MIN_SYMBOLS = {'hs_a': 1000, 'hs_b': 20}
+
+
+def get_all_symbols(use_cache=True):
+    """ all symbols of hs_a and hs_b, cached on disk for the trading day
+
+    an incomplete fetch is never cached, the last cached list is used instead
+    """
+    today = Helper.today()
+    cache = Helper.load_cache('symbols.json') if use_cache else None
+    if cache and cache.get('date') == today and cache.get('symbols'):
+        log.info('got {} from cache'.format(len(cache['symbols'])))
+        return cache['symbols']
+
+    import requests
     log.info('fetch all symbols from sina')
     url = ('http://vip.stock.finance.sina.com.cn/quotes_service/api/'
         'json_v2.php/Market_Center.getNameList?page=1&'
         'num=10000&sort=symbol&asc=1&node=')
     headers = {'User-Agent': 'Mozilla/5.0'}
     pat = re.compile(r'symbol:"([^"]+)"')
-    symbols = []
-    symbols.extend(pat.findall(requests.get(url + 'hs_a').text))
-    symbols.extend(pat.findall(requests.get(url + 'hs_b').text))
+    symbols, complete = [], True
+    for node, least in sorted(MIN_SYMBOLS.items()):
+        try:
+            resp = requests.get(url + node, headers=headers, timeout=10)
+            found = pat.findall(resp.text) if resp.ok else []
+        except requests.exceptions.RequestException as e:
+            log.error('fetch {} failed: {}'.format(node, e))
+            found = []
+        if len(found) < least:
+            log.error('got only {} symbols of {}'.format(len(found), node))
+            complete = False
+        symbols.extend(found)
     symbols = sorted(set(symbols))
     log.info('got {}'.format(len(symbols)))
+    if complete:
+        Helper.save_cache('symbols.json', {'date': today, 'symbols': symbols})
+    elif cache and cache.get('symbols'):
+        log.warning('use symbols cached on {}'.format(cache.get('date')))
+        return cache['symbols']
     return symbols
 
 
 class Transer(object):
 
     def __init__(self, username, password, symbols, out):
+        patch()
         self.client = L2Client(username, password)
         self.symbols = symbols or get_all_symbols()
         self.out = open(out, 'w')
@@ -58,6 +95,8 @@ class Transer(object):
                 bar.update(1)
 
     def run(self):
+        import tqdm
+        import gevent.pool
         if self.client.login():
             # tqdm has bug here, let it be None at now
             bar = tqdm.tqdm(total=len(self.symbols), desc='overall')
@@ -73,14 +112,23 @@ class Transer(object):
 
 
 class Watcher(object):
+    """ watches symbols with one websocket per `size` symbols
 
-    def __init__(self, username, password, symbols, raw, out, size=50):
+    with `fps` a L2Dashboard is shown instead of printing every message, it
+    is created after patching so its thread and locks are gevent ones
+    """
+    def __init__(self, username, password, symbols, raw, out, size=50, delta=False,
+                 fps=None):
+        if not symbols or len(symbols) > size:
+            patch()
         self.client = L2Client(username, password)
         self.symbols = symbols or get_all_symbols()
         self.raw = raw
         self.size = size
         self.out = self.ensure_file(out) if out else None
-        
+        self.encoder = DeltaEncoder() if delta and raw else None
+        self.dashboard = L2Dashboard(fps) if fps else None
+
     def ensure_file(self, out):
         return open(out, 'ab')
 
@@ -92,12 +140,20 @@ class Watcher(object):
                 result_list.append(vs)
         return result_list
 
+    def has_output(self):
+        """ whether on_data is used instead of printing to stdout """
+        return bool(self.out or self.dashboard)
+
     def on_data(self, data):
+        if self.dashboard:
+            self.dashboard.on_data(data)
         if self.out:
             if isinstance(data, str):
                 data = data.encode('utf-8')
             elif isinstance(data, dict) or isinstance(data, list):
                 data = json.dumps(data).encode('utf-8') + b'\n'
+            if self.encoder:
+                data = self.encoder.encode(data)
             self.out.write(data)
             if time.time() % 86400 > 7 * 3600 + 60:
                 self.client.market_closed = True
@@ -108,14 +164,24 @@ class Watcher(object):
             log.error('login failed')
             return
 
-        on_data = self.on_data if self.out else None
+        on_data = self.on_data if self.has_output() else None
         parse = False if self.raw else True
+        if self.dashboard:
+            self.dashboard.start()
 
-        g = gevent.pool.Group()
-        for symbols in self.split(self.symbols, self.size):
-            g.spawn(self.client.watch, symbols, on_data, parse)
-        g.join()
-        self.out.close()
+        symbols_list = self.split(self.symbols, self.size)
+        if len(symbols_list) == 1:
+            self.client.watch(symbols_list[0], on_data, parse)
+        else:
+            import gevent.pool
+            g = gevent.pool.Group()
+            for symbols in symbols_list:
+                g.spawn(self.client.watch, symbols, on_data, parse)
+            g.join()
+        if self.dashboard:
+            self.dashboard.stop()
+        if self.out:
+            self.out.close()
 
 
 class MultiProcessingWatcher(Watcher):
@@ -125,18 +191,22 @@ class MultiProcessingWatcher(Watcher):
     thus lags network(e.g. on Aliyun between 9:30-9:35)
     if you have a strong cpu, you should be fine with plain Watcher
     """
-    def __init__(self, username, password, symbols, raw, out, size=50, core=2):
+    def __init__(self, username, password, symbols, raw, out, size=50, core=2, delta=False):
         assert core > 1 and isinstance(core, int)
 
+        patch()
+        import gevent.lock
         self.client = L2Client(username, password)
         self.symbols = symbols or get_all_symbols()
         self.raw = raw
         self.size = size
         self.core = core
         self.out = out
+        self.encoder = DeltaEncoder() if delta and raw else None
         self.lock = gevent.lock.RLock()
 
     def main_on_data(self, r, f):
+        import gipc
         while True:
             try:
                 data = r.get()
@@ -147,6 +217,8 @@ class MultiProcessingWatcher(Watcher):
             elif isinstance(data, dict) or isinstance(data, list):
                 data = json.dumps(data).encode('utf-8')
             with self.lock:
+                if self.encoder:
+                    data = self.encoder.encode(data)
                 f.write(data)
 
     def child_on_data(self, w, data):
@@ -155,6 +227,7 @@ class MultiProcessingWatcher(Watcher):
             self.client.market_closed = True
 
     def spawn_watchs(self, w, symbols_list):
+        import gevent.pool
         parse = False if self.raw else True
         on_data = functools.partial(self.child_on_data, w) if self.out else None
         g = gevent.pool.Group()
@@ -163,6 +236,8 @@ class MultiProcessingWatcher(Watcher):
         g.join()
 
     def run(self):
+        import gipc
+        import gevent
         c = self.client
         if not c.login():
             log.error('login failed')
@@ -184,3 +259,79 @@ class MultiProcessingWatcher(Watcher):
         for g in gs:
             g.kill()
             g.join()
+
+
+class ShardWatcher(Watcher):
+    """ watches one shard of the symbols with its own account
+
+    the raw stream is written to `out` and served on `host`:`port` to
+    StreamMerger
+    """
+    def __init__(self, username, password, symbols, out=None, port=None, size=50,
+                 host='127.0.0.1'):
+        super(ShardWatcher, self).__init__(username, password, symbols, True, out, size)
+        self.server = StreamServer(host, port) if port else None
+
+    def has_output(self):
+        return bool(self.out or self.server)
+
+    def on_data(self, data):
+        if self.server:
+            self.server.publish(data)
+        super(ShardWatcher, self).on_data(data)
+        if time.time() % 86400 > 7 * 3600 + 60:
+            self.client.market_closed = True
+
+    def run(self):
+        if self.server:
+            self.server.start()
+        try:
+            super(ShardWatcher, self).run()
+        finally:
+            if self.server:
+                self.server.close()
+
+
+def run_shard(username, password, symbols, out, port, size):
+    ShardWatcher(username, password, symbols, out, port, size, '127.0.0.1').run()
+
+
+class ClusterWatcher(object):
+    """ one ShardWatcher process per account on this host
+
+    shard i is written to `out`.i and served on 127.0.0.1:`port` + i, the
+    main process merges all shards into `out` ordered by exchange time
+    """
+    def __init__(self, accounts, symbols, out, port=9000, size=50, timeout=3.):
+        assert accounts
+        patch()
+        self.accounts = accounts
+        self.symbols = symbols or get_all_symbols()
+        self.out = out
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+
+    def run(self):
+        import gipc
+        n = len(self.accounts)
+        ps = []
+        for i, (username, password) in enumerate(self.accounts):
+            args = (username, password, self.symbols[i::n],
+                    '{}.{}'.format(self.out, i), self.port + i, self.size)
+            ps.append(gipc.start_process(target=run_shard, args=args))
+
+        stop = threading.Event()
+        sources = [tcp_source('127.0.0.1', self.port + i, stop=stop) for i in range(n)]
+        merger = StreamMerger(sources, self.timeout, stop=stop)
+
+        def reap():
+            for p in ps:
+                p.join()
+            merger.stop()
+
+        t = threading.Thread(target=reap)
+        t.daemon = True
+        t.start()
+        with open(self.out, 'ab') as f:
+            merger.run(f)
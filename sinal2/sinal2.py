@@ -14,23 +14,26 @@ will be used to dump parsed info to stdout
 [2017-07-13T11:01:35.910000] TRANS sh601398 ▲ 5.12 x 4
 [2017-07-13T11:01:35.960000] TRANS sh601398 ▼ 5.11 x 1
 """
+import os
 import re
 import json
 import time
 import base64
 import select
+import shutil
+import hashlib
 import random
 import string 
+import sys
 import logging
 import binascii
 import threading
+import unicodedata
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor, wait
 
-import rsa
-import tqdm
-import requests
-import websocket
+# rsa, tqdm, requests and websocket are imported where they are used,
+# so that `import sinal2` and `sinal2 --help` stay fast
 
 
 log = logging.getLogger('sinal2')
@@ -39,14 +42,46 @@ log = logging.getLogger('sinal2')
 class Helper(object):
     CODES = string.ascii_letters + string.digits
     CACHES = {}
+    CACHE_DIR = os.environ.get(
+        'SINAL2_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'sinal2'))
 
     @classmethod
     def random_string(cls, length=9):
         return ''.join(random.sample(cls.CODES, length))
 
+    @classmethod
+    def today(cls):
+        """ date of the market (Asia/Shanghai) """
+        return (datetime.utcnow() + timedelta(hours=8)).strftime('%Y-%m-%d')
+
+    @classmethod
+    def load_cache(cls, name):
+        """ load json cache from CACHE_DIR, None if missing or broken """
+        path = os.path.join(cls.CACHE_DIR, name)
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @classmethod
+    def save_cache(cls, name, value):
+        """ save json cache to CACHE_DIR atomically, readable by owner only """
+        path = os.path.join(cls.CACHE_DIR, name)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(cls.CACHE_DIR, exist_ok=True)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+            os.replace(tmp, path)
+        except (IOError, OSError) as e:
+            log.warning('can not write cache {}: {}'.format(path, e))
+
     @classmethod
     def get_ip(cls):
         if 'ip' not in cls.CACHES:
+            import requests
             url = 'https://ff.sinajs.cn/?list=sys_clientip'
             resp = requests.get(url)
             ip = re.compile('"([^"]+)"').search(resp.text).group(1)
@@ -60,7 +95,11 @@ class SinaClient(object):
         'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)'
         ' Chrome/48.0.2564.116 Safari/537.36'
     )
+    SESSION_TTL = 86400
+    TOKEN_RETRY = 1
+
     def __init__(self, username, password, entry='finance'):
+        import requests
         self.username = username
         self.password = password
         assert entry in ['finance']
@@ -69,16 +108,68 @@ class SinaClient(object):
         session.headers['User-Agent'] = self.user_agent
         self.session = session
         self.is_logged_in = False
+        self.from_cache = False
+        self.login_lock = threading.Lock()
         self.uid = None
         self.nick = None
 
+    @property
+    def session_cache_name(self):
+        digest = hashlib.md5(self.username.encode('utf-8')).hexdigest()
+        return 'session_{}.json'.format(digest)
+
+    def save_session(self):
+        """ persist cookies, uid and client ip, expires with the first cookie or SESSION_TTL """
+        expires = time.time() + self.SESSION_TTL
+        cookies = []
+        for c in self.session.cookies:
+            cookies.append({'name': c.name, 'value': c.value, 'domain': c.domain,
+                            'path': c.path, 'expires': c.expires})
+            if c.expires:
+                expires = min(expires, c.expires)
+        Helper.save_cache(self.session_cache_name, {
+            'username': self.username,
+            'uid': self.uid,
+            'nick': self.nick,
+            'ip': Helper.get_ip(),
+            'cookies': cookies,
+            'expires': expires,
+        })
+
+    def load_session(self):
+        """ restore a logged in session from cache, False if missing or stale """
+        s = Helper.load_cache(self.session_cache_name)
+        try:
+            if s['username'] != self.username or not s['uid'] or not s['cookies']:
+                return False
+            if s['expires'] <= time.time():
+                log.info('cached session expired')
+                return False
+            for c in s['cookies']:
+                self.session.cookies.set(c['name'], c['value'], domain=c['domain'],
+                                         path=c['path'], expires=c['expires'])
+        except (KeyError, TypeError):
+            return False
+        if s.get('ip'):
+            Helper.CACHES['ip'] = s['ip']
+        self.is_logged_in = True
+        self.from_cache = True
+        self.uid = s['uid']
+        self.nick = s.get('nick')
+        return True
+
     def encrypt_passwd(self, passwd, pubkey, servertime, nonce):
+        import rsa
         key = rsa.PublicKey(int(pubkey, 16), int('10001', 16))
         message = str(servertime) + '\t' + str(nonce) + '\n' + str(passwd)
         passwd = rsa.encrypt(message.encode('utf-8'), key)
         return binascii.b2a_hex(passwd)
 
-    def login(self):
+    def login(self, use_cache=True):
+        if use_cache and self.load_session():
+            log.info('login from cache, uid {}, nick {}'.format(self.uid, self.nick))
+            return True
+        self.from_cache = False
         log.info('login {}/{}'.format(self.username, self.password))
         nameb64 = base64.b64encode(self.username.encode('utf-8'))
         resp = self.session.get(
@@ -124,8 +215,10 @@ class SinaClient(object):
             self.uid = j['uid']
             self.nick = j['nick']
             log.info('login success, uid {}, nick {}'.format(self.uid, self.nick))
+            self.save_session()
             return True
         else:
+            self.is_logged_in = False
             log.error(str(j))
 
 
@@ -136,6 +229,7 @@ class L2Parser(object):
     PAT_TRANS = re.compile('^2cn_([a-z0-9]{8})_[01]$')  # 逐笔成交
     # PAT_INFO = re.compile('^([a-z0-9]{8})_i$')  # 成交量等信息, 丢弃
     # PAT_OTHER = re.compile('^([a-z0-9]{8})$')  # 普通行情信息, 丢弃
+    PAT_TIME = re.compile(rb'(\d\d):(\d\d):(\d\d)(?:\.(\d{3}))?')
 
     QUOTE_STATUS = {
         'PH': '盘后',
@@ -180,6 +274,17 @@ class L2Parser(object):
                     result.extend(rs)
         return result
 
+    @classmethod
+    def timeof(cls, line):
+        """ seconds of day of the first time field in a raw line, None if not found """
+        m = cls.PAT_TIME.search(line)
+        if m:
+            h, mi, sec, ms = m.groups()
+            ts = int(h) * 3600 + int(mi) * 60 + int(sec)
+            if ms:
+                ts = round(ts + int(ms) / 1000., 3)
+            return ts
+
     @classmethod
     def str2timestamp(cls, s):
         d = datetime.utcnow()
@@ -356,6 +461,97 @@ class L2Printer(object):
             print(data)
 
 
+class L2Dashboard(object):
+    """ live terminal view, an alternative to L2Printer for many symbols
+
+    on_data only updates the latest quote and the trade summary of each
+    symbol, the screen is redrawn by a background thread at a fixed frame
+    rate, so rendering cost does not depend on the message rate
+
+    >>> d = L2Dashboard(fps=2)
+    >>> d.start()
+    >>> c.watch(symbols, on_data=d.on_data, parse=True)
+    """
+    CLEAR = '\x1b[H\x1b[2J'
+    HEADER = '{:<10s}{:<9s}{:>9s}{:>8s}{:>9s}{:>9s}{:>11s}{:>7s}{:>9s}{:>9s}{:>5s}'.format(
+        'symbol', 'name', 'price', 'chg%', 'bid1', 'ask1', 'volume',
+        'trades', 'buy', 'sell', 'st')
+
+    def __init__(self, fps=2):
+        self.interval = 1. / fps
+        self.quotes = {}
+        self.trades = {}
+        self.messages = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def on_data(self, data):
+        if isinstance(data, bytes):
+            data = L2Parser.parse(data)
+        if not isinstance(data, list):
+            return
+        # the render thread swaps trades and messages out every frame
+        with self.lock:
+            for x in data:
+                self.messages += 1
+                type_ = x['type']
+                if type_ == 'quote':
+                    self.quotes[x['symbol']] = x
+                elif type_ == 'trans':
+                    # count, buy volume, sell volume
+                    t = self.trades.get(x['symbol'])
+                    if t is None:
+                        t = self.trades[x['symbol']] = [0, 0, 0]
+                    t[0] += 1
+                    if x['iotype'] == '2':
+                        t[1] += x['volume']
+                    elif x['iotype'] == '0':
+                        t[2] += x['volume']
+
+    @classmethod
+    def ljust(cls, s, width):
+        """ pad by display width, CJK chars take 2 columns """
+        w = sum(2 if unicodedata.east_asian_width(c) in 'WF' else 1 for c in s)
+        return s + ' ' * max(width - w, 0)
+
+    def render(self, quotes, trades, messages, rows):
+        L = lambda v: int(round(v / 100))
+        lines = [
+            '[{}] {} symbols, {} msgs/s'.format(
+                datetime.now().strftime('%H:%M:%S'), len(quotes),
+                int(messages / self.interval)),
+            self.HEADER,
+        ]
+        for symbol in sorted(quotes)[:rows]:
+            q = quotes[symbol]
+            t = trades.get(symbol, (0, 0, 0))
+            chg = (q['price'] / q['pre_close'] - 1) * 100 if q['pre_close'] else 0.
+            lines.append(
+                '{:<10s}{}{:>9.2f}{:>8.2f}{:>9.2f}{:>9.2f}{:>11d}{:>7d}{:>9d}{:>9d}{:>5s}'.format(
+                    symbol, self.ljust(q['name'][:4], 9), q['price'], chg,
+                    q['bids'][0]['price'], q['asks'][0]['price'], L(q['volume']),
+                    t[0], L(t[1]), L(t[2]), q['status']))
+        return '\n'.join(lines)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                quotes = dict(self.quotes)
+                trades, self.trades = self.trades, {}
+                messages, self.messages = self.messages, 0
+            rows = shutil.get_terminal_size().lines - 3
+            sys.stdout.write(self.CLEAR + self.render(quotes, trades, messages, rows) + '\n')
+            sys.stdout.flush()
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+
 class L2Client(SinaClient):
     OPCODE_TEXT = 0x1
     OPCODE_CLOSE = 0x8
@@ -389,24 +585,44 @@ class L2Client(SinaClient):
                 channels.append(template.format(symbol))
         return ','.join(channels)
 
+    def relogin(self):
+        """ login again if the cached session was rejected, False if not logged in
+
+        websockets failing at the same time wait here for the first one
+        """
+        with self.login_lock:
+            if self.from_cache:
+                log.info('cached session rejected, login again')
+                self.from_cache = False
+                self.session.cookies.clear()
+                Helper.CACHES.pop('ip', None)
+                if not self.login(use_cache=False):
+                    self.is_logged_in = False
+        return self.is_logged_in
+
     def get_token(self, symbols, wlist):
-        ip = Helper.get_ip()
-        url = 'https://current.sina.com.cn/auth/api/jsonp.php/' + \
-            'var%20KKE_auth_{}=/'.format(Helper.random_string(9)) + \
-            'AuthSign_Service.getSignCode?' + \
-            'query=hq_pjb&ip={}&list={}&kick=1'.format(ip, wlist)
-        resp = self.session.get(url)
-        pat = re.compile('result:"([^"]+)",timeout:(\d+)')
-        m = pat.search(resp.text)
-        if m:
-            token, timeout = m.groups()
-            timeout = int(timeout)
-            return token
-        else:
+        """ token for the websocket, None once the login is lost """
+        pat = re.compile(r'result:"([^"]+)",timeout:(\d+)')
+        while True:
+            ip = Helper.get_ip()
+            url = 'https://current.sina.com.cn/auth/api/jsonp.php/' + \
+                'var%20KKE_auth_{}=/'.format(Helper.random_string(9)) + \
+                'AuthSign_Service.getSignCode?' + \
+                'query=hq_pjb&ip={}&list={}&kick=1'.format(ip, wlist)
+            resp = self.session.get(url)
+            m = pat.search(resp.text)
+            if m:
+                token, timeout = m.groups()
+                timeout = int(timeout)
+                return token
             log.error('token error: {}'.format(resp.text))
-            return self.get_token(symbols, wlist)
+            if not self.relogin():
+                log.error('not logged in, no token for {}'.format(','.join(symbols)))
+                return None
+            time.sleep(self.TOKEN_RETRY)
 
     def run_websocket(self, symbols, wlist, on_data=None, parse=True):
+        import websocket
         log.info('running websocket for symbols = {}'.format(','.join(symbols)))
         token = self.get_token(symbols, wlist)
         if not token:
@@ -422,7 +638,7 @@ class L2Client(SinaClient):
             nonlocal token
             while not stop_all.wait(interval):
                 token = self.get_token(symbols, wlist)
-                if ws and ws.connected:
+                if token and ws and ws.connected:
                     log.debug('send new token: {}'.format(token))
                     try:
                         ws.send('*' + token)
@@ -474,6 +690,8 @@ class L2Client(SinaClient):
         stop_all.set()
 
     def get_trans(self, symbol, concurrency=50, show_progress=True):
+        import tqdm
+        import requests
         sec = time.time() % 86400
         if  sec < 7 * 3600 or sec > 16 * 3600:
             log.error('can only download after 15:00')
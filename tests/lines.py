@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+""" raw level2 lines for tests """
+
+QUOTE = ('2cn_{symbol}=工商银行,{time},{date},5.060,5.060,5.150,5.050,{price},PZ,31226,'
+         '{volume},1122631869.880,16486243,5.006,38715067,5.218,5523,84270769,'
+         '426606888.550,4471,52469364,269632360.840,2170,5409,10,10,{price},5.070,'
+         '5.060,5.050,5.040,5.030,5.020,5.010,5.000,4.990,379972,1135225,1831588,'
+         '2495658,2601000,2316200,1027400,474700,1126100,345600,5.090,5.100,5.110,'
+         '5.120,5.130,5.140,5.150,5.160,5.170,5.180,2153900,1050798,395334,1192882,'
+         '1202366,4253802,3160019,4234541,1806971,2719567')
+ORDERS = ('2cn_{symbol}_orders={time},{time},5.080,379972,43,5.090,2153900,50,'
+          '43172|2900|300,,847800|100|20000,')
+TRANS = '{id}|{time}|{price}|{volume}|0|1|2|{iotype}|4'
+
+
+def hms(s, ms=False):
+    """ seconds of day to 'HH:MM:SS(.fff)' """
+    t = int(round(s * 1000))
+    r = '{:02d}:{:02d}:{:02d}'.format(t // 3600000, t // 60000 % 60, t // 1000 % 60)
+    if ms:
+        r += '.{:03d}'.format(t % 1000)
+    return r
+
+
+def quote(symbol, ts, price='5.080', volume=219835288, date='2017-07-12'):
+    return QUOTE.format(symbol=symbol, time=hms(ts), date=date, price=price,
+                        volume=volume)
+
+
+def orders(symbol, ts):
+    return ORDERS.format(symbol=symbol, time=hms(ts, True))
+
+
+def trans(symbol, trades, channel=1):
+    """ trades is a list of (id, ts, price, volume, iotype) """
+    return '2cn_{}_{}='.format(symbol, channel) + ','.join(
+        TRANS.format(id=i, time=hms(ts, True), price=p, volume=v, iotype=io)
+        for i, ts, p, v, io in trades)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from sinal2.clock import Clock
+
+
+def test_start_of_capture():
+    c = Clock(jump=300)
+    # last close's frames on subscription
+    assert c.feed('a_orders', 54003, 'a0') == ([], [])
+    assert c.feed('b_orders', 54003, 'b0') == ([], [])
+    assert c.feed('b_orders', 54003, 'b1') == ([], [])
+    # the channel goes back in time
+    assert c.feed('a_orders', 34200, 'a1') == ([], [(54003, 'a0')])
+    assert c.feed('a_orders', 34201, 'a2') == ([(34200, 'a1'), (34201, 'a2')], [])
+    assert c.value == 34201
+    assert c.feed('c_orders', 34202, 'c0') == ([(34202, 'c0')], [])
+    assert c.finish() == [(54003, 'b0'), (54003, 'b1')]
+
+
+def test_lunch_break():
+    c = Clock(jump=300)
+    assert c.feed('a', 41399, 'a0') == ([], [])
+    assert c.feed('a', 41400, 'a1') == ([(41399, 'a0'), (41400, 'a1')], [])
+    assert c.feed('b', 46800, 'b0') == ([], [])
+    assert c.feed('c', 46801, 'c0') == ([], [])
+    # late lines are accepted and keep what is held
+    assert c.feed('d', 41160, 'd0') == ([(41160, 'd0')], [])
+    assert c.feed('b', 46802, 'b1') == ([(46800, 'b0'), (46802, 'b1'), (46801, 'c0')], [])
+    assert c.value == 46802
+    assert c.feed('d', 41160, 'd1') == ([(41160, 'd1')], [])
+    assert c.finish() == []
+
+
+def test_watermark_catches_up():
+    c = Clock(jump=300)
+    c.feed('a', 36000, 'a0')
+    c.feed('a', 36001, 'a1')
+    assert c.feed('b', 36400, 'b0') == ([], [])
+    assert c.feed('a', 36120, 'a2') == ([(36120, 'a2'), (36400, 'b0')], [])
+    assert c.held == {}
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from sinal2 import runner
+from sinal2.sinal2 import L2Dashboard
+
+from lines import quote, trans
+
+
+def test_no_trades_lost_between_frames(capsys):
+    d = L2Dashboard(fps=500)
+    counted = []
+    d.render = lambda quotes, trades, messages, rows: counted.append(
+        sum(t[0] for t in trades.values())) or ''
+    frame = ('\n'.join(trans('sh6{:05d}'.format(i), [(1, 36000.5, '5.080', 100, '2')])
+                       for i in range(50)) + '\n').encode('utf-8')
+    d.start()
+    for _ in range(2000):
+        d.on_data(frame)
+    time.sleep(0.02)
+    d.stop()
+    time.sleep(0.02)
+    with d.lock:
+        left = sum(t[0] for t in d.trades.values())
+    assert sum(counted) + left == 2000 * 50
+
+
+def test_render():
+    d = L2Dashboard()
+    d.on_data((quote('sh601398', 36000) + '\n' +
+               trans('sh601398', [(1, 36000.5, '5.080', 500, '2'),
+                                  (2, 36000.6, '5.070', 300, '0')])).encode('utf-8'))
+    screen = d.render(d.quotes, d.trades, d.messages, 10)
+    row = screen.split('\n')[2].split()
+    assert row[0] == 'sh601398'
+    assert row[2:4] == ['5.08', '0.40']
+    assert row[-4:] == ['2', '5', '3', 'PZ']
+
+
+@pytest.mark.parametrize('n, patched', [(60, True), (3, False)])
+def test_dashboard_created_after_patch(monkeypatch, n, patched):
+    """ with many symbols the dashboard thread and locks must be gevent ones """
+    events = []
+    monkeypatch.setattr(runner, 'patch', lambda: events.append('patch'))
+    monkeypatch.setattr(runner, 'L2Client', lambda *args: None)
+
+    class Dashboard(L2Dashboard):
+        def __init__(self, fps):
+            events.append('dashboard')
+            super(Dashboard, self).__init__(fps)
+
+    monkeypatch.setattr(runner, 'L2Dashboard', Dashboard)
+    symbols = ['sh6{:05d}'.format(i) for i in range(n)]
+    w = runner.Watcher('u', 'p', symbols, False, None, size=50, fps=2)
+    assert isinstance(w.dashboard, Dashboard)
+    assert events == (['patch', 'dashboard'] if patched else ['dashboard'])
+    assert runner.Watcher('u', 'p', symbols, False, None, size=50).dashboard is None
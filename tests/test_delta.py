@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+from sinal2.delta import DeltaEncoder, DeltaDecoder
+
+from lines import quote, orders, trans
+
+
+def make_frames(n=200, seed=1):
+    rnd = random.Random(seed)
+    frames = []
+    for i in range(n):
+        ts = 36000 + i
+        lines = [quote('sh601398', ts, volume=219835288 + i // 7),
+                 orders('sh601398', 36000 + i // 3)]
+        if rnd.random() < 0.5:
+            lines.append(trans('sh601398', [(i, ts + 0.25, '5.080', 100, '2')]))
+        if rnd.random() < 0.2:
+            lines.append(quote('sz000001', ts, price='10.{:03d}'.format(i % 1000)))
+        frames.append(('\n'.join(lines) + '\n').encode('utf-8'))
+    return frames
+
+
+def test_roundtrip():
+    e, d = DeltaEncoder(), DeltaDecoder()
+    for frame in make_frames():
+        assert d.decode(e.encode(frame)) == frame
+
+
+def test_smaller():
+    e = DeltaEncoder()
+    frames = make_frames()
+    encoded = [e.encode(frame) for frame in frames]
+    assert sum(map(len, encoded)) * 3 < sum(map(len, frames))
+    # unchanged orders frame collapses to the channel name
+    assert b'2cn_sh601398_orders~\n' in encoded[1]
+
+
+def test_inflate_appended_capture(tmp_path):
+    """ a restarted watcher appends full frames to the same file """
+    frames = make_frames()
+    src, dst = str(tmp_path / 'all.l2d'), str(tmp_path / 'all.l2')
+    with open(src, 'wb') as f:
+        for part in (frames[:100], frames[100:]):
+            e = DeltaEncoder()
+            for frame in part:
+                f.write(e.encode(frame))
+    DeltaDecoder.inflate(src, dst)
+    with open(dst, 'rb') as f:
+        assert f.read() == b''.join(frames)
+
+
+def test_plain_lines_pass_through():
+    data = b'sys_auth=FAILED\nno equal sign\n'
+    assert DeltaDecoder().decode(DeltaEncoder().encode(data)) == data
+
+
+def test_delta_without_base():
+    with pytest.raises(ValueError):
+        DeltaDecoder().decode(b'2cn_sh601398~1:10:00:00\n')
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+from sinal2.index import L2Index
+
+from lines import hms, quote, orders, trans
+
+
+SYMBOLS = ['sh60{:04d}'.format(i) for i in range(20)]
+
+
+def write(path, lines):
+    with open(path, 'w') as f:
+        f.write(''.join(line + '\n' for line in lines))
+
+
+def make_day(seed=1, jitter=2.):
+    """ a capture around the lunch break with late lines, and its records
+
+    records are (ts, symbol, kind, price) in capture order
+    """
+    rnd = random.Random(seed)
+    events, records = [], []
+    last_quote = {}
+    for start, end in [(11 * 3600 + 25 * 60, 11 * 3600 + 30 * 60),
+                       (13 * 3600, 13 * 3600 + 5 * 60)]:
+        t = start
+        while t < end:
+            t = round(t + rnd.random() * 0.05, 3)
+            symbol = rnd.choice(SYMBOLS)
+            arrival = t + rnd.random() * jitter
+            price = '{:.3f}'.format(5 + rnd.random())
+            if rnd.random() < 0.3:
+                # quotes have second precision, at most one per second per symbol
+                ts = int(t)
+                if last_quote.get(symbol, -1) >= ts:
+                    continue
+                last_quote[symbol] = ts
+                events.append((arrival, quote(symbol, ts, price=price),
+                               [(ts, symbol, 'quote', price)]))
+            elif rnd.random() < 0.8:
+                trades = [(i, round(t + i * 0.001, 3), price, rnd.randint(1, 9999),
+                           str(rnd.randint(0, 2))) for i in range(2)]
+                events.append((arrival, trans(symbol, trades),
+                               [(ts, symbol, 'trans', price) for _, ts, _, _, _ in trades]))
+            else:
+                events.append((arrival, orders(symbol, t), []))
+    events.sort(key=lambda e: e[0])
+    for _, _, recs in events:
+        records.extend(recs)
+    return [line for _, line, _ in events], records
+
+
+def brute_force(records, until):
+    """ latest quote and trade price not after `until`, later lines win ties """
+    state = {}
+    for ts, symbol, kind, price in records:
+        if ts <= until:
+            s = state.setdefault(symbol, {})
+            if kind not in s or not ts < s[kind][0]:
+                s[kind] = (ts, float(price))
+    return state
+
+
+def summary(result):
+    state = {}
+    for symbol, r in result.items():
+        s = state.setdefault(symbol, {})
+        if r['quote']:
+            s['quote'] = (r['quote']['timestamp'], r['quote']['price'])
+        if r['trade']:
+            s['trans'] = (r['trade']['timestamp'], r['trade']['price'])
+    return state
+
+
+@pytest.mark.parametrize('interval', [10, 60])
+def test_asof_matches_brute_force(tmp_path, interval):
+    path = str(tmp_path / 'day.l2')
+    lines, records = make_day()
+    write(path, lines)
+    L2Index.build(path, interval=interval, lag=5)
+    idx = L2Index(path)
+    rnd = random.Random(2)
+    for _ in range(30):
+        until = round(rnd.uniform(11 * 3600 + 25 * 60, 13 * 3600 + 6 * 60), 3)
+        expect = brute_force(records, until)
+        assert summary(idx.asof(until)) == expect
+        some = SYMBOLS[:3]
+        got = summary(idx.asof(hms(until, True), symbols=some))
+        assert got == {s: expect[s] for s in some if s in expect}
+
+
+def test_millisecond_exact(tmp_path):
+    """ a trade stamped exactly T is the latest one not after T """
+    path = str(tmp_path / 'ms.l2')
+    t0 = 10 * 3600 + 30 * 60
+    lines = [trans('sh601398', [(i, round(t0 - 1 + i / 1000., 3), '5.080', 100 + i, '2')])
+             for i in range(2000)]
+    write(path, lines)
+    L2Index.build(path, interval=30, lag=5)
+    idx = L2Index(path)
+    for ms in range(1000):
+        trade = idx.asof('10:30:00.{:03d}'.format(ms))['sh601398']['trade']
+        assert trade['volume'] == 100 + 1000 + ms
+
+
+def test_stray_line_ahead(tmp_path):
+    """ last close's frame received before the open must not advance the index """
+    path = str(tmp_path / 'stray.l2')
+    t0 = 9 * 3600 + 30 * 60
+    lines = [orders('sh600000', 15 * 3600 + 3)]
+    for i in range(3600):
+        lines.append(trans('sh601398', [(i, t0 + i, '5.080', 100 + i, '2')]))
+        if i == 1800:
+            lines.append(trans('sh600000', [(1, 15 * 3600, '9.000', 1, '0')]))
+    write(path, lines)
+    L2Index.build(path, interval=30, lag=5)
+    idx = L2Index(path)
+    state = idx.asof('10:00:00.000')
+    assert state['sh601398']['trade']['volume'] == 100 + 1800
+    assert 'sh600000' not in state
+    assert idx.asof('10:20:00.000')['sh601398']['trade']['volume'] == 100 + 3000
+
+
+def test_stale_day_quotes(tmp_path):
+    """ pre-open snapshots of the previous day are ignored """
+    path = str(tmp_path / 'stale.l2')
+    lines = []
+    for symbol in SYMBOLS:
+        lines.append(quote(symbol, 15 * 3600 + 3, price='9.000', date='2017-07-11'))
+        lines.append(orders(symbol, 15 * 3600 + 3))
+        lines.append(trans(symbol, [(1, 15 * 3600 + 0.5, '9.000', 1, '0')]))
+    t0 = 9 * 3600 + 30 * 60
+    for i in range(1200):
+        symbol = SYMBOLS[i % len(SYMBOLS)]
+        lines.append(quote(symbol, t0 + i, price='5.{:03d}'.format(i % 1000)))
+    write(path, lines)
+    L2Index.build(path, interval=30, lag=5)
+    idx = L2Index(path)
+    state = idx.asof('09:45:00.000')
+    assert len(state) == len(SYMBOLS)
+    assert all(s['quote']['price'] < 6 for s in state.values())
+    assert all(s['trade'] is None for s in state.values())
+    assert all(s['quote']['price'] < 6 for s in idx.asof('15:00:05').values())
+
+
+@pytest.mark.parametrize('when', ['10:30', '24:00:00', '10:61:00', '10:30:00.5', '', None, -1])
+def test_bad_time(when):
+    with pytest.raises(ValueError):
+        L2Index.seconds(when)
+
+
+def test_delta_capture_rejected(tmp_path):
+    path = str(tmp_path / 'day.l2d')
+    write(path, [quote('sh601398', 36000), 'sh601398~1:10:00:01'])
+    with pytest.raises(ValueError):
+        L2Index.build(path)
+
+
+def test_old_orders_after_lunch(tmp_path):
+    """ snapshots with old times mixed into the restart do not hide the afternoon """
+    path = str(tmp_path / 'lunch.l2')
+    t0, t1 = 11 * 3600 + 29 * 60, 13 * 3600
+    lines = [trans('sh601398', [(i, t0 + i, '5.080', 100 + i, '2')]) for i in range(60)]
+    for i in range(600):
+        lines.append(trans('sh601398', [(60 + i, t1 + i * 0.5, '5.090', 1000 + i, '1')]))
+        if i % 10 == 0:
+            lines.append(orders('sh600000', 11 * 3600 + 26 * 60))
+    write(path, lines)
+    L2Index.build(path, interval=10, lag=5)
+    idx = L2Index(path)
+    assert idx.asof('13:01:00')['sh601398']['trade']['volume'] == 1000 + 120
+    assert idx.asof('13:04:00')['sh601398']['trade']['volume'] == 1000 + 480
+    assert idx.asof('11:29:59.000')['sh601398']['trade']['volume'] == 100 + 59
+
+
+def test_last_close_frames_before_open(tmp_path):
+    """ undated frames of last close received on subscription are ignored """
+    path = str(tmp_path / 'open.l2')
+    lines = [orders(s, 15 * 3600 + 3) for s in SYMBOLS + SYMBOLS[:10]]
+    lines += [trans(s, [(1, 15 * 3600 - 3, '9.000', 1, '0')]) for s in SYMBOLS + SYMBOLS[:10]]
+    t0 = 9 * 3600 + 30 * 60
+    for i in range(3600):
+        symbol = SYMBOLS[i % 5]
+        lines.append(trans(symbol, [(10 + i, t0 + i, '5.080', 100 + i, '2')]))
+    write(path, lines)
+    L2Index.build(path, interval=10, lag=5)
+    idx = L2Index(path)
+    state = idx.asof('10:00:00')
+    assert sorted(state) == SYMBOLS[:5]
+    assert state[SYMBOLS[0]]['trade']['volume'] == 100 + 1800
+    assert all(s['trade']['price'] < 6 for s in idx.asof('15:00:05').values())
+    assert len(idx.strays) == (len(SYMBOLS) + 10) * 2
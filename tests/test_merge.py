@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import time
+import socket
+import threading
+
+from sinal2.merge import StreamServer, StreamMerger, tcp_source, file_source
+from sinal2.sinal2 import L2Parser
+
+from lines import orders, trans
+
+
+T0 = 10 * 3600
+
+
+def line(symbol, ts):
+    return orders(symbol, ts).encode('utf-8')
+
+
+def times(lines):
+    return [L2Parser.timeof(line) for line in lines]
+
+
+def write(path, lines):
+    with open(path, 'wb') as f:
+        f.write(b''.join(line + b'\n' for line in lines))
+
+
+def blocked(event, lines=()):
+    """ a source sending `lines`, then silent until event is set """
+    for line in lines:
+        yield line
+    event.wait()
+
+
+def serve():
+    server = StreamServer(port=0)
+    server.start()
+    return server, server.sock.getsockname()[1]
+
+
+def wait_for(cond, timeout=5.):
+    deadline = time.time() + timeout
+    while not cond():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_files_merged_in_order(tmp_path):
+    paths = []
+    for i in range(3):
+        path = str(tmp_path / 'shard{}.l2'.format(i))
+        write(path, [line('sh60000{}'.format(i), T0 + t * 0.1 + i * 0.03)
+                     for t in range(200)])
+        paths.append(path)
+    merger = StreamMerger([file_source(p) for p in paths], lag=0)
+    merged = list(merger)
+    assert len(merged) == 600
+    assert times(merged) == sorted(times(merged))
+    assert merger.late == 0
+
+
+def test_last_close_frames_before_open(tmp_path):
+    """ last close's frames sent on subscription do not break the ordering """
+    paths = []
+    for i in range(2):
+        path = str(tmp_path / 'shard{}.l2'.format(i))
+        lines = [line('sh60000{}'.format(i), 15 * 3600 + 3)]
+        lines += [trans('sh60001{}'.format(i), [(t, T0 + t * 0.5 + i * 0.1, '5.080', 100, '1')])
+                  .encode('utf-8') for t in range(2000)]
+        write(path, lines)
+        paths.append(path)
+    merger = StreamMerger([file_source(p) for p in paths], lag=0)
+    merged = list(merger)
+    assert len(merged) == 4002
+    assert merger.late == 0
+    assert merger.strays == 2
+    assert times(merged[:4000]) == sorted(times(merged[:4000]))
+    assert times(merged[4000:]) == [15 * 3600 + 3] * 2
+
+
+def test_late_worker():
+    """ a worker silent for more than timeout holds the merge back only that long """
+    go = threading.Event()
+
+    def late():
+        go.wait()
+        yield line('sh600001', T0 + 1)
+
+    fast = [line('sh600000', T0 + t) for t in range(10)]
+    merger = StreamMerger([iter(fast), late()], timeout=0.3, lag=0)
+    it = iter(merger)
+    start = time.time()
+    assert times(next(it) for _ in range(10)) == [T0 + t for t in range(10)]
+    assert 0.2 < time.time() - start < 3
+    go.set()
+    assert times(it) == [T0 + 1]
+    assert merger.late == 1
+
+
+def test_silent_worker_and_stop():
+    silent = threading.Event()
+    first = [line('sh600000', T0), line('sh600000', T0 + 1)]
+    merger = StreamMerger([iter(first), blocked(silent)], timeout=0.2)
+    it = iter(merger)
+    assert times([next(it), next(it)]) == [T0, T0 + 1]
+    merger.stop()
+    assert list(it) == []
+    silent.set()
+
+
+def test_buffer_is_bounded():
+    """ a worker heard from but behind does not make the merge buffer grow """
+    silent = threading.Event()
+    fast = [line('sh600000', T0 + t * 0.01) for t in range(1000)]
+    merger = StreamMerger([iter(fast), blocked(silent)], timeout=60, lag=0, buffer=100)
+    it = iter(merger)
+    first = [next(it) for _ in range(900)]
+    assert times(first) == [T0 + t * 0.01 for t in range(900)]
+    merger.stop()
+    assert len(list(it)) == 100
+    silent.set()
+
+
+def test_slow_merger_is_dropped():
+    """ publish never blocks on a merger that does not read """
+    server, port = serve()
+    server.backlog = 10
+    conn = socket.create_connection(('127.0.0.1', port))
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    try:
+        wait_for(lambda: server.clients)
+        data = b'x' * (1 << 16)
+        start = time.time()
+        for _ in range(2000):
+            server.publish(data)
+            if not server.clients:
+                break
+        assert not server.clients
+        assert time.time() - start < 5
+    finally:
+        conn.close()
+        server.close()
+
+
+def test_merge_from_workers_with_restart():
+    stop = threading.Event()
+    servers = [serve() for _ in range(2)]
+    sources = [tcp_source('127.0.0.1', port, wait=5, stop=stop) for _, port in servers]
+    merger = StreamMerger(sources, timeout=1., lag=0, stop=stop)
+    out = []
+    t = threading.Thread(target=lambda: out.extend(merger))
+    t.start()
+    try:
+        wait_for(lambda: all(s.clients for s, _ in servers))
+        for k in range(50):
+            for i, (s, _) in enumerate(servers):
+                s.publish(line('sh60000{}'.format(i), T0 + k + i * 0.5))
+        wait_for(lambda: len(out) >= 98)
+
+        # worker 1 restarts on the same port, the merger reconnects
+        server, port = servers[1]
+        server.close()
+        server = StreamServer(port=port)
+        server.start()
+        servers[1] = (server, port)
+        wait_for(lambda: server.clients)
+        for k in range(50, 60):
+            for s, _ in servers:
+                s.publish(line('sh600000', T0 + k))
+        wait_for(lambda: len(out) >= 118)
+    finally:
+        merger.stop()
+        t.join(5)
+        for s, _ in servers:
+            s.close()
+    assert not t.is_alive()
+    assert len(out) == 120
+    assert times(out) == sorted(times(out))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+import pytest
+
+from sinal2.sinal2 import Helper, L2Client
+
+
+TOKEN = 'var KKE_auth_x=({result:"TOKEN",timeout:180})'
+REJECTED = 'var KKE_auth_x=({result:"",error:"not logged in"})'
+
+
+class Cookie(object):
+
+    def __init__(self, name, value, domain=None, path=None, expires=None):
+        self.name, self.value = name, value
+        self.domain, self.path, self.expires = domain, path, expires
+
+
+class Jar(list):
+
+    def set(self, name, value, **kwargs):
+        self.append(Cookie(name, value, **kwargs))
+
+
+class Response(object):
+
+    def __init__(self, text):
+        self.text = text
+
+
+class Session(object):
+    """ token requests succeed once `valid` is set, like after a real login """
+
+    def __init__(self, valid=True):
+        self.cookies = Jar()
+        self.valid = valid
+        self.gets = 0
+
+    def get(self, url):
+        self.gets += 1
+        return Response(TOKEN if self.valid else REJECTED)
+
+
+def client(username='user', valid=True):
+    """ L2Client without requests, as __init__ builds it """
+    c = L2Client.__new__(L2Client)
+    c.username, c.password, c.entry = username, 'pass', 'finance'
+    c.session = Session(valid)
+    c.is_logged_in = c.from_cache = False
+    c.login_lock = threading.Lock()
+    c.uid = c.nick = None
+    return c
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(Helper, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(Helper, 'CACHES', {'ip': '1.2.3.4'})
+    monkeypatch.setattr(L2Client, 'TOKEN_RETRY', 0)
+
+
+def logged_in(expires=None, username='user'):
+    c = client(username)
+    c.session.cookies.set('SUB', 'abc', domain='.sina.com.cn', path='/', expires=expires)
+    c.uid, c.nick = '123', 'nick'
+    c.save_session()
+    return c
+
+
+def test_session_roundtrip():
+    logged_in(expires=time.time() + 3600)
+    Helper.CACHES.clear()
+    c = client()
+    assert c.load_session()
+    assert c.is_logged_in and c.from_cache
+    assert (c.uid, c.nick) == ('123', 'nick')
+    assert [(x.name, x.value, x.domain) for x in c.session.cookies] == [
+        ('SUB', 'abc', '.sina.com.cn')]
+    assert Helper.CACHES['ip'] == '1.2.3.4'
+
+
+def test_session_expired(monkeypatch):
+    logged_in(expires=time.time() - 1)
+    assert not client().load_session()
+    # without cookie expiry the session lasts SESSION_TTL
+    logged_in()
+    assert client().load_session()
+    monkeypatch.setattr(L2Client, 'SESSION_TTL', -1)
+    logged_in()
+    c = client()
+    assert not c.load_session()
+    assert not c.is_logged_in
+
+
+def test_session_of_another_user():
+    other = logged_in(username='other')
+    Helper.save_cache(client().session_cache_name,
+                      Helper.load_cache(other.session_cache_name))
+    assert not client().load_session()
+
+
+@pytest.mark.parametrize('content', ['{broken', '[]', '"x"', '{}',
+                                     '{"username": "user", "uid": "1", "cookies": [{}],'
+                                     ' "expires": 1e12}'])
+def test_session_cache_broken(content):
+    with open(Helper.CACHE_DIR + '/' + client().session_cache_name, 'w') as f:
+        f.write(content)
+    c = client()
+    assert not c.load_session()
+    assert not c.is_logged_in
+
+
+def test_rejected_session_falls_back_to_login():
+    logged_in(expires=time.time() + 3600)
+    c = client(valid=False)
+    calls = []
+
+    def login(use_cache=True):
+        calls.append(use_cache)
+        assert 'ip' not in Helper.CACHES
+        Helper.CACHES['ip'] = '5.6.7.8'
+        c.session.valid = c.is_logged_in = True
+        return True
+
+    assert c.load_session()
+    c.login = login
+    assert c.get_token(['sh601398'], 'x') == 'TOKEN'
+    assert calls == [False]
+    assert not c.from_cache
+    assert list(c.session.cookies) == []
+
+
+def test_failed_login_after_rejection_gives_up():
+    logged_in(expires=time.time() + 3600)
+    c = client(valid=False)
+    assert c.load_session()
+    c.login = lambda use_cache=True: None
+    assert c.get_token(['sh601398'], 'x') is None
+    assert not c.is_logged_in
+    assert c.session.gets == 1
+
+
+def test_websockets_wait_for_one_login(monkeypatch):
+    monkeypatch.setattr(Helper, 'get_ip', lambda: '5.6.7.8')
+    logged_in(expires=time.time() + 3600)
+    c = client(valid=False)
+    calls = []
+
+    def login(use_cache=True):
+        calls.append(use_cache)
+        time.sleep(0.2)
+        c.session.valid = c.is_logged_in = True
+        return True
+
+    assert c.load_session()
+    c.login = login
+    tokens = []
+    ts = [threading.Thread(target=lambda: tokens.append(c.get_token(['sh601398'], 'x')))
+          for _ in range(20)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    assert tokens == ['TOKEN'] * 20
+    assert calls == [False]
+    assert c.session.gets <= 40